@@ -1,16 +1,39 @@
 import os
-import psycopg2
-import psycopg2.extras
+import atexit
+import numpy as np
+import psycopg
+from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
+from cachetools import TTLCache
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-from flask import Flask, render_template, request, redirect, session, url_for, flash, jsonify, send_file
+from flask import Flask, render_template, request, redirect, session, url_for, flash, jsonify, Response
+from flask_compress import Compress
 from functools import wraps
+import hashlib
+from pydantic import BaseModel, StringConstraints, ValidationError
+from typing import Annotated
 import secrets
-import math
+from math import sin, cos, asin, sqrt, radians
 import io
 import csv
+import json
+import threading
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'a_strong_default_secret_key_for_development')
+Compress(app)
 
 # --- Application Configuration ---
 CLASS_NAME = 'B.A. - AIH'
@@ -26,14 +49,67 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 if not DATABASE_URL:
     raise RuntimeError("FATAL: The DATABASE_URL environment variable is not set.")
 
-def get_db_connection():
+# Pool size is tunable so multiple gunicorn workers don't exhaust the
+# PostgreSQL max_connections limit (each worker gets its own pool).
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 2))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 20))
+
+POOL = ConnectionPool(DATABASE_URL, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, open=True)
+atexit.register(POOL.close)
+
+@contextmanager
+def db_conn():
+    """Check a connection out of the pool and return it when done.
+
+    The pool's context manager commits on clean exit and rolls back if the
+    block raises, so the connection always goes back in a usable state.
+    """
+    with POOL.connection() as conn:
+        yield conn
+
+# --- Response Cache (optional) ---
+# Every connected student polls get_present_students during an active session,
+# so identical SELECTs hit PostgreSQL many times per second. A short-TTL Redis
+# cache absorbs those. Caching is skipped entirely if REDIS_URL is not set.
+REDIS_URL = os.environ.get('REDIS_URL')
+CACHE = redis.Redis.from_url(REDIS_URL) if (redis and REDIS_URL) else None
+PRESENCE_CACHE_TTL = int(os.environ.get('PRESENCE_CACHE_TTL', 3))
+
+def cache_get(key):
+    if CACHE is None:
+        return None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        return conn
-    except psycopg2.OperationalError as e:
-        print(f"FATAL: Database connection failed: {e}")
+        return CACHE.get(key)
+    except redis.RedisError:
         return None
 
+def cache_set(key, value, ttl):
+    if CACHE is None:
+        return
+    try:
+        CACHE.setex(key, ttl, value)
+    except redis.RedisError:
+        pass
+
+def cache_delete(key):
+    if CACHE is None:
+        return
+    try:
+        CACHE.delete(key)
+    except redis.RedisError:
+        pass
+
+def conditional_json(payload):
+    """Serve a serialized JSON payload with an ETag; unchanged polls get a 304."""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    etag = hashlib.blake2b(payload, digest_size=16).hexdigest()
+    if request.if_none_match.contains(etag):
+        return Response(status=304)
+    resp = Response(payload, mimetype='application/json')
+    resp.set_etag(etag)
+    return resp
+
 # --- Decorator ---
 def controller_required(f):
     @wraps(f)
@@ -48,21 +124,76 @@ def controller_required(f):
 
 # --- Helper Functions ---
 def haversine_distance(lat1, lon1, lat2, lon2):
-    R = 6371000 # Earth radius in meters
-    phi1, phi2 = math.radians(lat1), math.radians(lat2)
-    delta_phi, delta_lambda = math.radians(lat2 - lat1), math.radians(lon2 - lon1)
-    a = math.sin(delta_phi / 2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2)**2
-    return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
-def get_class_id_by_name(cursor):
-    cursor.execute("SELECT id FROM classes WHERE class_name = %s", (CLASS_NAME,))
-    result = cursor.fetchone()
-    return result[0] if result else None
-
-def get_controller_id_by_username(cursor):
-    cursor.execute("SELECT id FROM users WHERE username = 'controller'")
-    result = cursor.fetchone()
-    return result[0] if result else None
+    # 2*R*asin(sqrt(a)) form: one sqrt + one asin instead of two sqrts + atan2.
+    # 12742000 = 2 * 6371000 (Earth diameter in meters).
+    p1, p2 = radians(lat1), radians(lat2)
+    s1 = sin((p2 - p1) * 0.5)
+    s2 = sin(radians(lon2 - lon1) * 0.5)
+    a = s1 * s1 + cos(p1) * cos(p2) * s2 * s2
+    return 12742000.0 * asin(sqrt(a))
+
+def haversine_np(lat1, lon1, lat2, lon2):
+    """Vectorized haversine: lat2/lon2 may be arrays, returns distances in meters."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    dphi = lat2 - lat1
+    dlam = lon2 - lon1
+    a = np.sin(dphi / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlam / 2)**2
+    return 6371000 * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+if njit is not None:
+    # JIT-compiled batch haversine for large audits; compiled to native code
+    # on first call and cached on disk. Falls back to the NumPy version when
+    # numba (an optional accelerator, not in requirements) is not installed.
+    @njit(cache=True, fastmath=True)
+    def haversine_nb(lat1, lon1, lat2, lon2):
+        p1 = radians(lat1)
+        out = np.empty(lat2.shape[0])
+        for i in range(lat2.shape[0]):
+            p2 = radians(lat2[i])
+            s1 = sin((p2 - p1) * 0.5)
+            s2 = sin(radians(lon2[i] - lon1) * 0.5)
+            a = s1 * s1 + cos(p1) * cos(p2) * s2 * s2
+            out[i] = 12742000.0 * asin(sqrt(a))
+        return out
+else:
+    haversine_nb = haversine_np
+
+def utc_day_bounds(day):
+    """Half-open [start, end) UTC timestamps covering a calendar day.
+
+    Range predicates on start_time keep the queries SARGable: a plain btree
+    index applies, unlike DATE(start_time AT TIME ZONE 'UTC') = %s.
+    """
+    day_start = datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+    return day_start, day_start + timedelta(days=1)
+
+# The class and controller rows never change while the process is running,
+# so both IDs are resolved once and cached, saving one query per request.
+_CLASS_ID = None
+_CONTROLLER_ID = None
+_ID_CACHE_LOCK = threading.Lock()
+
+def get_class_id_by_name(conn):
+    global _CLASS_ID
+    if _CLASS_ID is None:
+        with _ID_CACHE_LOCK:
+            if _CLASS_ID is None:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT id FROM classes WHERE class_name = %s", (CLASS_NAME,))
+                    result = cur.fetchone()
+                _CLASS_ID = result[0] if result else None
+    return _CLASS_ID
+
+def get_controller_id_by_username(conn):
+    global _CONTROLLER_ID
+    if _CONTROLLER_ID is None:
+        with _ID_CACHE_LOCK:
+            if _CONTROLLER_ID is None:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT id FROM users WHERE username = 'controller'")
+                    result = cur.fetchone()
+                _CONTROLLER_ID = result[0] if result else None
+    return _CONTROLLER_ID
 
 # --- Main & Auth Routes ---
 @app.route('/')
@@ -75,14 +206,10 @@ def home():
 def login():
     if request.method == 'POST':
         username, password = request.form.get('username'), request.form.get('password')
-        conn = get_db_connection()
-        if not conn:
-            flash("Database service unavailable.", "danger")
-            return render_template('login.html', class_name=CLASS_NAME)
         try:
-            with conn.cursor() as cur:
+            with db_conn() as conn:
                 if username == CONTROLLER_USERNAME and password == CONTROLLER_PASSWORD:
-                    controller_id = get_controller_id_by_username(cur)
+                    controller_id = get_controller_id_by_username(conn)
                     if controller_id:
                         session.clear()
                         session['user_id'] = controller_id
@@ -93,8 +220,8 @@ def login():
                         flash("Controller user not configured in the database.", "danger")
                 else:
                     flash("Invalid credentials.", "danger")
-        finally:
-            if conn: conn.close()
+        except psycopg.OperationalError:
+            flash("Database service unavailable.", "danger")
     return render_template('login.html', class_name=CLASS_NAME)
 
 @app.route('/logout')
@@ -107,374 +234,499 @@ def logout():
 @app.route('/student')
 def student_page():
     active_session, present_students, geofence_data = None, [], None
-    conn = get_db_connection()
-    if conn:
-        try:
-            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-                class_id = get_class_id_by_name(cur)
+    try:
+        with db_conn() as conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                class_id = get_class_id_by_name(conn)
                 if class_id:
                     cur.execute("""
-                        SELECT s.id, s.end_time, c.geofence_lat, c.geofence_lon, c.geofence_radius 
-                        FROM attendance_sessions s 
-                        JOIN classes c ON s.class_id = c.id 
-                        WHERE s.class_id = %s AND s.is_active = TRUE AND s.end_time > NOW() AT TIME ZONE 'UTC' 
+                        SELECT s.id, s.end_time, c.geofence_lat, c.geofence_lon, c.geofence_radius
+                        FROM attendance_sessions s
+                        JOIN classes c ON s.class_id = c.id
+                        WHERE s.class_id = %s AND s.is_active = TRUE AND s.end_time > NOW() AT TIME ZONE 'UTC'
                         LIMIT 1
-                    """, (class_id,))
+                    """, (class_id,), prepare=True)
                     session_data = cur.fetchone()
                     if session_data:
                         active_session = {'id': session_data['id'], 'end_time': session_data['end_time'].isoformat()}
                         geofence_data = { 'lat': session_data['geofence_lat'], 'lon': session_data['geofence_lon'], 'radius': session_data['geofence_radius'] }
                     else:
-                        today_utc = datetime.now(timezone.utc).date()
+                        day_start, day_end = utc_day_bounds(datetime.now(timezone.utc).date())
                         cur.execute("""
-                            SELECT DISTINCT s.name, s.enrollment_no 
-                            FROM students s 
-                            JOIN attendance_records ar ON s.id = ar.student_id 
-                            JOIN attendance_sessions ases ON ar.session_id = ases.id 
-                            WHERE ases.class_id = %s AND DATE(ases.start_time AT TIME ZONE 'UTC') = %s 
+                            SELECT DISTINCT s.name, s.enrollment_no
+                            FROM students s
+                            JOIN attendance_records ar ON s.id = ar.student_id
+                            JOIN attendance_sessions ases ON ar.session_id = ases.id
+                            WHERE ases.class_id = %s AND ases.start_time >= %s AND ases.start_time < %s
                             ORDER BY s.name ASC
-                        """, (class_id, today_utc))
+                        """, (class_id, day_start, day_end), prepare=True)
                         present_students = cur.fetchall()
-        finally:
-            if conn: conn.close()
+    except psycopg.OperationalError:
+        pass
     return render_template('student_attendance.html', active_session=active_session, present_students=present_students, class_name=CLASS_NAME, geofence_data=geofence_data)
 
 @app.route('/controller_dashboard')
 @controller_required
 def controller_dashboard():
     active_session = None
-    conn = get_db_connection()
-    if conn:
-        try:
-            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-                class_id = get_class_id_by_name(cur)
+    try:
+        with db_conn() as conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                class_id = get_class_id_by_name(conn)
                 if class_id:
-                    cur.execute("SELECT id, end_time FROM attendance_sessions WHERE class_id = %s AND is_active = TRUE AND end_time > NOW() AT TIME ZONE 'UTC' LIMIT 1", (class_id,))
+                    cur.execute("SELECT id, end_time FROM attendance_sessions WHERE class_id = %s AND is_active = TRUE AND end_time > NOW() AT TIME ZONE 'UTC' LIMIT 1", (class_id,), prepare=True)
                     active_session = cur.fetchone()
-        finally:
-            if conn: conn.close()
+    except psycopg.OperationalError:
+        pass
     return render_template('admin_dashboard.html', active_session=active_session, class_name=CLASS_NAME, username=session.get('username'))
 
 @app.route('/attendance_report')
 @controller_required
 def attendance_report():
-    conn = get_db_connection()
-    if not conn:
-        flash("Database connection failed.", "danger")
-        return redirect(url_for('controller_dashboard'))
     report_data, students = [], []
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            class_id = get_class_id_by_name(cur)
-            if not class_id:
-                flash("Class not found in database.", "danger")
-                return render_template('attendance_report.html', report_data=[], students=[], class_name=CLASS_NAME)
-            
-            cur.execute("SELECT id, name, enrollment_no FROM students WHERE batch = %s ORDER BY enrollment_no", (BATCH_CODE,))
-            students = cur.fetchall()
-            cur.execute("SELECT DISTINCT DATE(start_time AT TIME ZONE 'UTC') as class_date FROM attendance_sessions WHERE class_id = %s ORDER BY class_date DESC", (class_id,))
-            class_dates = [row['class_date'] for row in cur.fetchall()]
-            
-            for class_date in class_dates:
-                daily_entry = {'date': class_date.strftime('%Y-%m-%d'), 'students': []}
-                cur.execute("SELECT DISTINCT student_id FROM attendance_records ar JOIN attendance_sessions s ON ar.session_id = s.id WHERE s.class_id = %s AND DATE(s.start_time AT TIME ZONE 'UTC') = %s", (class_id, class_date))
-                present_ids = {row['student_id'] for row in cur.fetchall()}
-                daily_entry['students'] = [{'status': 'Present' if student['id'] in present_ids else 'Absent'} for student in students]
-                report_data.append(daily_entry)
-    finally:
-        if conn: conn.close()
+        with db_conn() as conn:
+            # Dict rows only for the student list the template reads by name;
+            # the date and presence fetches are tuple cursors.
+            with conn.cursor(row_factory=dict_row) as cur, conn.cursor() as plain_cur:
+                class_id = get_class_id_by_name(conn)
+                if not class_id:
+                    flash("Class not found in database.", "danger")
+                    return render_template('attendance_report.html', report_data=[], students=[], class_name=CLASS_NAME)
+
+                cur.execute("SELECT id, name, enrollment_no FROM students WHERE batch = %s ORDER BY enrollment_no", (BATCH_CODE,))
+                students = cur.fetchall()
+                plain_cur.execute("SELECT DISTINCT DATE(start_time AT TIME ZONE 'UTC') as class_date FROM attendance_sessions WHERE class_id = %s ORDER BY class_date DESC", (class_id,))
+                class_dates = [row[0] for row in plain_cur.fetchall()]
+
+                # One query for all (date, student) pairs instead of one per class date.
+                plain_cur.execute("SELECT DATE(s.start_time AT TIME ZONE 'UTC') AS class_date, ar.student_id FROM attendance_records ar JOIN attendance_sessions s ON ar.session_id = s.id WHERE s.class_id = %s", (class_id,))
+                presence = defaultdict(set)
+                for class_date, student_id in plain_cur.fetchall():
+                    presence[class_date].add(student_id)
+
+                for class_date in class_dates:
+                    present_ids = presence[class_date]
+                    report_data.append({
+                        'date': class_date.strftime('%Y-%m-%d'),
+                        'students': [{'status': 'Present' if student['id'] in present_ids else 'Absent'} for student in students]
+                    })
+    except psycopg.OperationalError:
+        flash("Database connection failed.", "danger")
+        return redirect(url_for('controller_dashboard'))
     return render_template('attendance_report.html', report_data=report_data, students=students, class_name=CLASS_NAME)
 
 @app.route('/export_csv')
 @controller_required
 def export_csv():
     csv_config = { 'school_name': 'AIH Dept.', 'course_title': 'AIH-DSM-311', 'professor_name': 'KRS Chandel' }
-    conn = get_db_connection()
-    if not conn:
+    try:
+        with db_conn() as conn:
+            with conn.cursor(row_factory=dict_row) as cur, conn.cursor() as plain_cur:
+                class_id = get_class_id_by_name(conn)
+                plain_cur.execute("SELECT MIN(start_time AT TIME ZONE 'UTC') as first_date FROM attendance_sessions WHERE class_id = %s", (class_id,))
+                first_date_record = plain_cur.fetchone()
+                if not first_date_record or not first_date_record[0]:
+                    flash("No attendance data to export.", "info")
+                    return redirect(url_for('attendance_report'))
+                start_date = first_date_record[0].date()
+                end_date = datetime.now(timezone.utc).date()
+                date_range = [start_date + timedelta(days=x) for x in range((end_date - start_date).days + 1)]
+                cur.execute("SELECT id, name, enrollment_no FROM students WHERE batch = %s ORDER BY enrollment_no", (BATCH_CODE,))
+                students = cur.fetchall()
+                plain_cur.execute("SELECT DISTINCT DATE(start_time AT TIME ZONE 'UTC') as session_date FROM attendance_sessions WHERE class_id = %s", (class_id,))
+                session_days = {row[0] for row in plain_cur.fetchall()}
+                total_working_days = len(session_days)
+
+                # Pivot attendance into a (student, day) boolean matrix indexed by
+                # row number and day offset, instead of probing a dict keyed on
+                # (student_id, date) tuples for every cell.
+                num_days = len(date_range)
+                sid_to_row = {s['id']: i for i, s in enumerate(students)}
+                present = np.zeros((len(students), num_days), dtype=bool)
+                is_session_day = np.zeros(num_days, dtype=bool)
+                for day in session_days:
+                    offset = (day - start_date).days
+                    if 0 <= offset < num_days:
+                        is_session_day[offset] = True
+                # Server-side cursor: the records table is the one unbounded
+                # fetch here, so stream it in batches of plain tuples instead of
+                # materializing one giant list of dict rows.
+                with conn.cursor('export_stream') as rec_cur:
+                    rec_cur.itersize = 5000
+                    rec_cur.execute("SELECT ar.student_id, DATE(s.start_time AT TIME ZONE 'UTC') AS session_date FROM attendance_records ar JOIN attendance_sessions s ON ar.session_id = s.id WHERE s.class_id = %s", (class_id,))
+                    for student_id, session_date in rec_cur:
+                        row = sid_to_row.get(student_id)
+                        offset = (session_date - start_date).days
+                        if row is not None and 0 <= offset < num_days:
+                            present[row, offset] = True
+
+                absent_or_holiday = np.where(is_session_day, 'A', 'H')
+                present_counts = present.sum(axis=1)
+
+                # Stream the CSV one row at a time rather than buffering the whole
+                # file in memory before sending. The writer goes through a
+                # TextIOWrapper straight onto bytes, so each chunk is yielded
+                # without an intermediate str copy to encode.
+                def generate():
+                    buf = io.BytesIO()
+                    text = io.TextIOWrapper(buf, encoding='utf-8', newline='', write_through=True)
+                    writer = csv.writer(text)
+                    def flush():
+                        data = buf.getvalue()
+                        buf.seek(0)
+                        buf.truncate(0)
+                        return data
+                    writer.writerows([['School Name:', csv_config['school_name']], ['Course Title:', csv_config['course_title']], ['Professor Name:', csv_config['professor_name']], [], ['Key:'], ['P', 'Present'], ['A', 'Absent'], ['H', 'Holiday'], []])
+                    writer.writerow(['Student Name', 'ID Number'] + [d.strftime('%Y-%m-%d') for d in date_range] + ['Attendance %'])
+                    yield flush()
+                    for i, student in enumerate(students):
+                        row_data = np.where(present[i], 'P', absent_or_holiday)
+                        percentage = (present_counts[i] / total_working_days * 100) if total_working_days > 0 else 0
+                        percentage_str = f"{percentage:.1f}%"
+                        writer.writerow([student['name'], student['enrollment_no']] + row_data.tolist() + [percentage_str])
+                        yield flush()
+
+                file_name = f"AIH_Attendance_Report_{start_date}_to_{end_date}.csv"
+                return Response(generate(), mimetype='text/csv', headers={'Content-Disposition': f'attachment; filename={file_name}'})
+    except psycopg.OperationalError:
         flash("Database connection failed.", "danger")
         return redirect(url_for('attendance_report'))
-    try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            class_id = get_class_id_by_name(cur)
-            cur.execute("SELECT MIN(start_time AT TIME ZONE 'UTC') as first_date FROM attendance_sessions WHERE class_id = %s", (class_id,))
-            first_date_record = cur.fetchone()
-            if not first_date_record or not first_date_record['first_date']:
-                flash("No attendance data to export.", "info")
-                return redirect(url_for('attendance_report'))
-            start_date = first_date_record['first_date'].date()
-            end_date = datetime.now(timezone.utc).date()
-            date_range = [start_date + timedelta(days=x) for x in range((end_date - start_date).days + 1)]
-            cur.execute("SELECT id, name, enrollment_no FROM students WHERE batch = %s ORDER BY enrollment_no", (BATCH_CODE,))
-            students = cur.fetchall()
-            cur.execute("SELECT DISTINCT DATE(start_time AT TIME ZONE 'UTC') as session_date FROM attendance_sessions WHERE class_id = %s", (class_id,))
-            session_days = {row['session_date'] for row in cur.fetchall()}
-            total_working_days = len(session_days)
-            cur.execute("SELECT ar.student_id, DATE(s.start_time AT TIME ZONE 'UTC') AS session_date FROM attendance_records ar JOIN attendance_sessions s ON ar.session_id = s.id WHERE s.class_id = %s", (class_id,))
-            attendance_map = { (rec['student_id'], rec['session_date']): 'P' for rec in cur.fetchall() }
-            output = io.StringIO()
-            writer = csv.writer(output)
-            writer.writerows([['School Name:', csv_config['school_name']], ['Course Title:', csv_config['course_title']], ['Professor Name:', csv_config['professor_name']], [], ['Key:'], ['P', 'Present'], ['A', 'Absent'], ['H', 'Holiday'], []])
-            header = ['Student Name', 'ID Number'] + [d.strftime('%Y-%m-%d') for d in date_range] + ['Attendance %']
-            writer.writerow(header)
-            for student in students:
-                present_count = 0
-                row_data = []
-                for date in date_range:
-                    status = 'H'
-                    if date in session_days:
-                        if attendance_map.get((student['id'], date)) == 'P':
-                            status = 'P'
-                            present_count += 1
-                        else:
-                            status = 'A'
-                    row_data.append(status)
-                percentage = (present_count / total_working_days * 100) if total_working_days > 0 else 0
-                percentage_str = f"{percentage:.1f}%"
-                writer.writerow([student['name'], student['enrollment_no']] + row_data + [percentage_str])
-            output.seek(0)
-            file_name = f"AIH_Attendance_Report_{start_date}_to_{end_date}.csv"
-            return send_file(io.BytesIO(output.getvalue().encode('utf-8')), mimetype='text/csv', as_attachment=True, download_name=file_name)
-    finally:
-        if conn: conn.close()
 
 # --- API Endpoints ---
+class MarkAttendanceIn(BaseModel):
+    """Form payload for mark_attendance, validated before a connection is taken."""
+    enrollment_no: Annotated[str, StringConstraints(strip_whitespace=True, to_upper=True, min_length=1)]
+    session_id: int
+    fingerprint: Annotated[str, StringConstraints(min_length=1)]
+    latitude: float
+    longitude: float
+    location_method: str | None = None
+
 @app.route('/api/mark_attendance', methods=['POST'])
 def api_mark_attendance():
-    data = request.form
+    # Reject malformed input before acquiring a pooled connection, so bad
+    # requests never tie up pool capacity.
+    try:
+        payload = MarkAttendanceIn.model_validate(request.form.to_dict())
+    except ValidationError:
+        return jsonify({"success": False, "message": "Missing required data."}), 400
     user_ip = request.headers.get('X-Forwarded-For', request.remote_addr).split(',')[0].strip()
-    conn = get_db_connection()
-    if not conn: return jsonify({"success": False, "message": "Database service unavailable."}), 503
-    
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            enrollment_no = data.get('enrollment_no', '').strip().upper()
-            session_id = data.get('session_id')
-            fingerprint = data.get('fingerprint')
-            if not all([enrollment_no, session_id, fingerprint]):
-                return jsonify({"success": False, "message": "Missing required data."}), 400
-
-            cur.execute("SELECT id, name FROM students WHERE enrollment_no = %s AND batch = %s", (enrollment_no, BATCH_CODE))
-            student = cur.fetchone()
-            if not student: return jsonify({"success": False, "message": "Enrollment number not found.", "category": "danger"}), 404
-
-            cur.execute("SELECT 1 FROM attendance_records ar JOIN attendance_sessions s ON ar.session_id = s.id WHERE ar.student_id = %s AND DATE(s.start_time AT TIME ZONE 'UTC') = %s", (student['id'], datetime.now(timezone.utc).date()))
-            if cur.fetchone(): return jsonify({"success": False, "message": "You have already marked attendance today.", "category": "warning"}), 409
-            
-            cur.execute("SELECT s.id, c.geofence_lat, c.geofence_lon, c.geofence_radius FROM attendance_sessions s JOIN classes c ON s.class_id = c.id WHERE s.id = %s AND s.is_active = TRUE AND s.end_time > NOW() AT TIME ZONE 'UTC'", (session_id,))
-            session_info = cur.fetchone()
-            if not session_info: return jsonify({"success": False, "message": "Session has expired or is invalid.", "category": "danger"}), 400
-            
-            geofence_radius = session_info['geofence_radius'] or GEOFENCE_RADIUS
-            distance = haversine_distance(float(data['latitude']), float(data['longitude']), session_info['geofence_lat'], session_info['geofence_lon'])
-            if distance > geofence_radius:
-                if data.get('location_method') == 'gps':
-                    return jsonify({ "success": False, "category": "retry_high_accuracy", "message": "GPS is outside the area. Trying a precise check..." })
-                return jsonify({ "success": False, "message": f"You are {distance:.0f}m away. Please move within the {geofence_radius}m radius.", "category": "danger" }), 403
-            
-            # --- DYNAMIC DUPLICATE CHECK LOGIC ---
-            cur.execute("""
-                SELECT ar.ip_address 
-                FROM attendance_records ar 
-                JOIN session_device_fingerprints sdf ON ar.session_id = sdf.session_id AND ar.student_id = sdf.student_id 
-                WHERE sdf.session_id = %s AND sdf.fingerprint = %s
-            """, (session_info['id'], fingerprint))
-            existing_record = cur.fetchone()
-            
-            if existing_record and existing_record['ip_address'] == user_ip:
-                # Block only if both fingerprint and IP match an existing record
-                return jsonify({"success": False, "message": "This device and network combination has already been used.", "category": "danger"}), 403
-
-            # --- Insert Records (Transaction) ---
-            cur.execute("INSERT INTO attendance_records (session_id, student_id, timestamp, latitude, longitude, ip_address) VALUES (%s, %s, NOW() AT TIME ZONE 'UTC', %s, %s, %s)", (session_info['id'], student['id'], data['latitude'], data['longitude'], user_ip))
-            cur.execute("INSERT INTO session_device_fingerprints (session_id, student_id, fingerprint) VALUES (%s, %s, %s)", (session_info['id'], student['id'], fingerprint))
-            conn.commit()
-            
-            return jsonify({"success": True, "message": f"{student['name']}, your attendance is marked!", "category": "success"})
-
-    except (Exception, psycopg2.Error) as e:
-        if conn: conn.rollback()
-        print(f"ERROR in api_mark_attendance: {e}")
-        return jsonify({"success": False, "message": "A server error occurred."}), 500
-    finally:
-        if conn: conn.close()
+        with db_conn() as conn:
+            try:
+                with conn.cursor(row_factory=dict_row) as cur:
+                    day_start, day_end = utc_day_bounds(datetime.now(timezone.utc).date())
+
+                    # Single round-trip: all validation (student, duplicate-today,
+                    # session, geofence, device+IP duplicate) and both inserts run
+                    # in one CTE statement; the final SELECT reports which check
+                    # failed so the route can pick the right response.
+                    cur.execute("""
+                        WITH stu AS (
+                            SELECT id, name FROM students WHERE enrollment_no = %s AND batch = %s
+                        ), ses AS (
+                            SELECT s.id, COALESCE(c.geofence_radius, %s) AS radius,
+                                   12742000.0 * asin(least(1.0, sqrt(
+                                       power(sin(radians(c.geofence_lat - %s) / 2), 2)
+                                       + cos(radians(%s)) * cos(radians(c.geofence_lat))
+                                       * power(sin(radians(c.geofence_lon - %s) / 2), 2)
+                                   ))) AS distance_m
+                            FROM attendance_sessions s JOIN classes c ON s.class_id = c.id
+                            WHERE s.id = %s AND s.is_active = TRUE AND s.end_time > NOW() AT TIME ZONE 'UTC'
+                        ), dup_today AS (
+                            SELECT 1 AS hit FROM attendance_records ar
+                            JOIN attendance_sessions s2 ON ar.session_id = s2.id
+                            WHERE ar.student_id = (SELECT id FROM stu)
+                              AND s2.start_time >= %s AND s2.start_time < %s
+                            LIMIT 1
+                        ), dev_dup AS (
+                            SELECT ar.ip_address FROM attendance_records ar
+                            JOIN session_device_fingerprints sdf ON ar.session_id = sdf.session_id AND ar.student_id = sdf.student_id
+                            WHERE sdf.session_id = (SELECT id FROM ses) AND sdf.fingerprint = %s
+                        ), ins AS (
+                            INSERT INTO attendance_records (session_id, student_id, timestamp, latitude, longitude, ip_address)
+                            SELECT ses.id, stu.id, NOW() AT TIME ZONE 'UTC', %s, %s, %s
+                            FROM stu, ses
+                            WHERE ses.distance_m <= ses.radius
+                              AND NOT EXISTS (SELECT 1 FROM dup_today)
+                              AND NOT EXISTS (SELECT 1 FROM dev_dup WHERE ip_address = %s)
+                            RETURNING session_id, student_id
+                        ), ins_fp AS (
+                            INSERT INTO session_device_fingerprints (session_id, student_id, fingerprint)
+                            SELECT session_id, student_id, %s FROM ins
+                            ON CONFLICT DO NOTHING
+                        )
+                        SELECT (SELECT name FROM stu) AS student_name,
+                               (SELECT id FROM ses) AS valid_session_id,
+                               (SELECT distance_m FROM ses) AS distance_m,
+                               (SELECT radius FROM ses) AS radius,
+                               EXISTS (SELECT 1 FROM dup_today) AS already_today,
+                               EXISTS (SELECT 1 FROM dev_dup WHERE ip_address = %s) AS device_dup,
+                               (SELECT COUNT(*) FROM ins) AS inserted
+                    """, (payload.enrollment_no, BATCH_CODE, GEOFENCE_RADIUS,
+                          payload.latitude, payload.latitude, payload.longitude, payload.session_id,
+                          day_start, day_end, payload.fingerprint,
+                          payload.latitude, payload.longitude, user_ip, user_ip,
+                          payload.fingerprint, user_ip), prepare=True)
+                    result = cur.fetchone()
+                    conn.commit()
+
+                    if not result['student_name']:
+                        return jsonify({"success": False, "message": "Enrollment number not found.", "category": "danger"}), 404
+                    if result['already_today']:
+                        return jsonify({"success": False, "message": "You have already marked attendance today.", "category": "warning"}), 409
+                    if not result['valid_session_id']:
+                        return jsonify({"success": False, "message": "Session has expired or is invalid.", "category": "danger"}), 400
+                    if result['inserted']:
+                        cache_delete(f"presence:{result['valid_session_id']}")
+                        return jsonify({"success": True, "message": f"{result['student_name']}, your attendance is marked!", "category": "success"})
+                    if result['distance_m'] > result['radius']:
+                        if payload.location_method == 'gps':
+                            return jsonify({ "success": False, "category": "retry_high_accuracy", "message": "GPS is outside the area. Trying a precise check..." })
+                        return jsonify({ "success": False, "message": f"You are {result['distance_m']:.0f}m away. Please move within the {result['radius']}m radius.", "category": "danger" }), 403
+                    # Block only if both fingerprint and IP match an existing record
+                    return jsonify({"success": False, "message": "This device and network combination has already been used.", "category": "danger"}), 403
+            except (Exception, psycopg.Error) as e:
+                conn.rollback()
+                print(f"ERROR in api_mark_attendance: {e}")
+                return jsonify({"success": False, "message": "A server error occurred."}), 500
+    except psycopg.OperationalError:
+        return jsonify({"success": False, "message": "Database service unavailable."}), 503
 
 @app.route('/api/start_session', methods=['POST'])
 @controller_required
 def api_start_session():
-    conn = get_db_connection()
-    if not conn: return jsonify({"success": False, "message": "Database error."}), 503
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            class_id = get_class_id_by_name(cur)
-            if not class_id:
-                 return jsonify({"success": False, "message": "Class not configured. Cannot start session."}), 404
-            
-            cur.execute("SELECT id FROM attendance_sessions WHERE class_id = %s AND is_active = TRUE AND end_time > NOW() AT TIME ZONE 'UTC'", (class_id,))
-            if cur.fetchone(): return jsonify({"success": False, "message": "An active session already exists."}), 409
-            
-            cur.execute("""
-                INSERT INTO attendance_sessions (class_id, controller_id, session_token, start_time, end_time, is_active) 
-                VALUES (%s, %s, %s, NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC' + interval '5 minutes', TRUE) 
-                RETURNING id, end_time
-            """, (class_id, session['user_id'], secrets.token_hex(16)))
-            new_session = cur.fetchone()
-            conn.commit()
-            return jsonify({"success": True, "session": new_session})
-    except (Exception, psycopg2.Error) as e:
-        if conn: conn.rollback()
-        print(f"Error in api_start_session: {e}")
-        return jsonify({"success": False, "message": "Server error."}), 500
-    finally:
-        if conn: conn.close()
+        with db_conn() as conn:
+            try:
+                with conn.cursor(row_factory=dict_row) as cur:
+                    class_id = get_class_id_by_name(conn)
+                    if not class_id:
+                         return jsonify({"success": False, "message": "Class not configured. Cannot start session."}), 404
+
+                    # The advisory lock serializes concurrent start clicks for the
+                    # class; the conditional insert then checks and creates in one
+                    # statement, so two controllers can never both see "no active
+                    # session" and insert. Commit releases the lock.
+                    cur.execute("SELECT pg_advisory_xact_lock(%s)", (class_id,))
+                    cur.execute("""
+                        INSERT INTO attendance_sessions (class_id, controller_id, session_token, start_time, end_time, is_active)
+                        SELECT %s, %s, %s, NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC' + interval '5 minutes', TRUE
+                        WHERE NOT EXISTS (SELECT 1 FROM attendance_sessions WHERE class_id = %s AND is_active = TRUE AND end_time > NOW() AT TIME ZONE 'UTC')
+                        RETURNING id, end_time
+                    """, (class_id, session['user_id'], secrets.token_hex(16), class_id))
+                    new_session = cur.fetchone()
+                    conn.commit()
+                    if not new_session:
+                        return jsonify({"success": False, "message": "An active session already exists."}), 409
+                    return jsonify({"success": True, "session": new_session})
+            except (Exception, psycopg.Error) as e:
+                conn.rollback()
+                print(f"Error in api_start_session: {e}")
+                return jsonify({"success": False, "message": "Server error."}), 500
+    except psycopg.OperationalError:
+        return jsonify({"success": False, "message": "Database error."}), 503
 
 @app.route('/api/end_session/<int:session_id>', methods=['POST'])
 @controller_required
 def api_end_session(session_id):
-    conn = get_db_connection()
-    if not conn: return jsonify({"success": False, "message": "Database error."})
     try:
-        with conn.cursor() as cur:
-            cur.execute("UPDATE attendance_sessions SET is_active = FALSE, end_time = NOW() AT TIME ZONE 'UTC' WHERE id = %s AND controller_id = %s", (session_id, session['user_id']))
-            conn.commit()
-            return jsonify({"success": True, "message": "Session ended."})
-    finally:
-        if conn: conn.close()
-        
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("UPDATE attendance_sessions SET is_active = FALSE, end_time = NOW() AT TIME ZONE 'UTC' WHERE id = %s AND controller_id = %s", (session_id, session['user_id']))
+                conn.commit()
+                return jsonify({"success": True, "message": "Session ended."})
+    except psycopg.OperationalError:
+        return jsonify({"success": False, "message": "Database error."})
+
+# get_student_name fires on every keystroke of the enrollment field and the
+# students table is static while the app runs, so repeat lookups — hits and
+# misses alike — are served from a small in-process TTL cache.
+_NAME_MISS = object()
+_NAME_CACHE = TTLCache(maxsize=2048, ttl=300)
+_NAME_CACHE_LOCK = threading.Lock()
+
 @app.route('/api/get_student_name/<enrollment_no>')
 def api_get_student_name(enrollment_no):
-    conn = get_db_connection()
-    if not conn: return jsonify({"success": False})
+    enrollment_no = enrollment_no.upper()
+    with _NAME_CACHE_LOCK:
+        cached = _NAME_CACHE.get(enrollment_no)
+    if cached is not None:
+        return jsonify({"success": True, "name": cached}) if cached is not _NAME_MISS else jsonify({"success": False})
     try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT name FROM students WHERE enrollment_no = %s AND batch = %s", (enrollment_no.upper(), BATCH_CODE))
-            result = cur.fetchone()
-            return jsonify({"success": True, "name": result[0]}) if result else jsonify({"success": False})
-    finally:
-        if conn: conn.close()
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT name FROM students WHERE enrollment_no = %s AND batch = %s", (enrollment_no, BATCH_CODE), prepare=True)
+                result = cur.fetchone()
+        with _NAME_CACHE_LOCK:
+            _NAME_CACHE[enrollment_no] = result[0] if result else _NAME_MISS
+        return jsonify({"success": True, "name": result[0]}) if result else jsonify({"success": False})
+    except psycopg.OperationalError:
+        return jsonify({"success": False})
 
 @app.route('/api/get_present_students/<int:session_id>')
 def api_get_present_students(session_id):
-    conn = get_db_connection()
-    if not conn: return jsonify({"success": False, "students": []})
+    cache_key = f"presence:{session_id}"
+    cached = cache_get(cache_key)
+    if cached is not None:
+        return conditional_json(cached)
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute("SELECT s.name, s.enrollment_no FROM students s JOIN attendance_records ar ON s.id = ar.student_id WHERE ar.session_id = %s ORDER BY s.name ASC", (session_id,))
-            students = cur.fetchall()
-            return jsonify({"success": True, "students": students})
-    finally:
-        if conn: conn.close()
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT s.name, s.enrollment_no FROM students s JOIN attendance_records ar ON s.id = ar.student_id WHERE ar.session_id = %s ORDER BY s.name ASC", (session_id,), prepare=True)
+                students = [{'name': name, 'enrollment_no': enrollment_no} for name, enrollment_no in cur.fetchall()]
+                payload = json.dumps({"success": True, "students": students})
+                cache_set(cache_key, payload, PRESENCE_CACHE_TTL)
+                return conditional_json(payload)
+    except psycopg.OperationalError:
+        return jsonify({"success": False, "students": []})
 
 @app.route('/api/get_students_for_session/<int:session_id>')
 @controller_required
 def api_get_students_for_session(session_id):
-    conn = get_db_connection()
-    if not conn: return jsonify({"success": False, "message": "Database error."}), 500
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute("SELECT id, enrollment_no, name FROM students WHERE batch = %s ORDER BY enrollment_no", (BATCH_CODE,))
-            all_students = cur.fetchall()
-            cur.execute("SELECT student_id FROM attendance_records WHERE session_id = %s", (session_id,))
-            present_ids = {row['student_id'] for row in cur.fetchall()}
-            student_data = [{'id': s['id'], 'enrollment_no': s['enrollment_no'], 'name': s['name'], 'is_present': s['id'] in present_ids} for s in all_students]
-            return jsonify({"success": True, "students": student_data})
-    finally:
-        if conn: conn.close()
+        with db_conn() as conn:
+            with conn.cursor(row_factory=dict_row) as cur, conn.cursor() as id_cur:
+                # The two queries are independent, so pipeline them onto the
+                # wire together instead of waiting for each reply in turn.
+                with conn.pipeline():
+                    cur.execute("SELECT id, enrollment_no, name FROM students WHERE batch = %s ORDER BY enrollment_no", (BATCH_CODE,))
+                    id_cur.execute("SELECT student_id FROM attendance_records WHERE session_id = %s", (session_id,))
+                all_students = cur.fetchall()
+                present_ids = {row[0] for row in id_cur.fetchall()}
+                student_data = [{'id': s['id'], 'enrollment_no': s['enrollment_no'], 'name': s['name'], 'is_present': s['id'] in present_ids} for s in all_students]
+                return conditional_json(json.dumps({"success": True, "students": student_data}))
+    except psycopg.OperationalError:
+        return jsonify({"success": False, "message": "Database error."}), 500
 
 @app.route('/api/toggle_attendance_for_session', methods=['POST'])
 @controller_required
 def api_toggle_attendance_for_session():
     data = request.get_json()
     session_id, student_id, is_present = data.get('session_id'), data.get('student_id'), data.get('is_present')
-    conn = get_db_connection()
-    if not conn: return jsonify({"success": False, "message": "Database error."}), 500
     try:
-        with conn.cursor() as cur:
-            if is_present:
-                cur.execute("INSERT INTO attendance_records (session_id, student_id, timestamp, ip_address) VALUES (%s, %s, NOW() AT TIME ZONE 'UTC', 'Live Edit') ON CONFLICT (session_id, student_id) DO NOTHING", (session_id, student_id))
-            else:
-                cur.execute("DELETE FROM attendance_records WHERE session_id = %s AND student_id = %s", (session_id, student_id))
-            conn.commit()
-            return jsonify({"success": True})
-    except (Exception, psycopg2.Error) as e:
-        if conn: conn.rollback()
-        return jsonify({"success": False, "message": "Server error."}), 500
-    finally:
-        if conn: conn.close()
+        with db_conn() as conn:
+            try:
+                with conn.cursor() as cur:
+                    if is_present:
+                        cur.execute("INSERT INTO attendance_records (session_id, student_id, timestamp, ip_address) VALUES (%s, %s, NOW() AT TIME ZONE 'UTC', 'Live Edit') ON CONFLICT (session_id, student_id) DO NOTHING", (session_id, student_id))
+                    else:
+                        cur.execute("DELETE FROM attendance_records WHERE session_id = %s AND student_id = %s", (session_id, student_id))
+                    conn.commit()
+                    cache_delete(f"presence:{session_id}")
+                    return jsonify({"success": True})
+            except (Exception, psycopg.Error) as e:
+                conn.rollback()
+                return jsonify({"success": False, "message": "Server error."}), 500
+    except psycopg.OperationalError:
+        return jsonify({"success": False, "message": "Database error."}), 500
 
 @app.route('/api/get_students_for_day/<date_str>')
 @controller_required
 def api_get_students_for_day(date_str):
-    conn = get_db_connection()
-    if not conn: return jsonify({"success": False, "message": "Database error."}), 500
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            class_id = get_class_id_by_name(cur)
-            day_to_query = datetime.strptime(date_str, '%Y-%m-%d').date()
-            cur.execute("SELECT id, enrollment_no, name FROM students WHERE batch = %s ORDER BY enrollment_no", (BATCH_CODE,))
-            all_students = cur.fetchall()
-            cur.execute("SELECT DISTINCT ar.student_id FROM attendance_records ar JOIN attendance_sessions s ON ar.session_id = s.id WHERE s.class_id = %s AND DATE(s.start_time AT TIME ZONE 'UTC') = %s", (class_id, day_to_query))
-            present_ids = {row['student_id'] for row in cur.fetchall()}
-            student_data = [{'id': s['id'], 'enrollment_no': s['enrollment_no'], 'name': s['name'], 'is_present': s['id'] in present_ids} for s in all_students]
-            return jsonify({"success": True, "students": student_data})
-    finally:
-        if conn: conn.close()
+        with db_conn() as conn:
+            with conn.cursor(row_factory=dict_row) as cur, conn.cursor() as id_cur:
+                class_id = get_class_id_by_name(conn)
+                day_start, day_end = utc_day_bounds(datetime.strptime(date_str, '%Y-%m-%d').date())
+                with conn.pipeline():
+                    cur.execute("SELECT id, enrollment_no, name FROM students WHERE batch = %s ORDER BY enrollment_no", (BATCH_CODE,))
+                    id_cur.execute("SELECT DISTINCT ar.student_id FROM attendance_records ar JOIN attendance_sessions s ON ar.session_id = s.id WHERE s.class_id = %s AND s.start_time >= %s AND s.start_time < %s", (class_id, day_start, day_end))
+                all_students = cur.fetchall()
+                present_ids = {row[0] for row in id_cur.fetchall()}
+                student_data = [{'id': s['id'], 'enrollment_no': s['enrollment_no'], 'name': s['name'], 'is_present': s['id'] in present_ids} for s in all_students]
+                return jsonify({"success": True, "students": student_data})
+    except psycopg.OperationalError:
+        return jsonify({"success": False, "message": "Database error."}), 500
 
 @app.route('/api/toggle_attendance_for_day', methods=['POST'])
 @controller_required
 def api_toggle_attendance_for_day():
     data = request.get_json()
     date_str, student_id, is_present = data.get('date'), data.get('student_id'), data.get('is_present')
-    conn = get_db_connection()
-    if not conn: return jsonify({"success": False, "message": "Database error."}), 500
     try:
-        with conn.cursor() as cur:
-            class_id = get_class_id_by_name(cur)
-            target_date = datetime.strptime(date_str, '%Y-%m-%d').date()
-            cur.execute("SELECT id FROM attendance_sessions WHERE class_id = %s AND DATE(start_time AT TIME ZONE 'UTC') = %s ORDER BY start_time", (class_id, target_date))
-            session_ids = [row[0] for row in cur.fetchall()]
-            if is_present:
-                session_to_use = session_ids[0] if session_ids else None
-                if not session_to_use:
-                    start_of_day = datetime.combine(target_date, datetime.min.time(), tzinfo=timezone.utc)
-                    cur.execute("INSERT INTO attendance_sessions (class_id, controller_id, session_token, start_time, end_time, is_active) VALUES (%s, %s, %s, %s, %s, FALSE) RETURNING id", (class_id, session['user_id'], f"manual-{secrets.token_hex(8)}", start_of_day, start_of_day))
-                    session_to_use = cur.fetchone()[0]
-                cur.execute("INSERT INTO attendance_records (session_id, student_id, timestamp, ip_address) VALUES (%s, %s, NOW() AT TIME ZONE 'UTC', 'Manual Edit') ON CONFLICT (session_id, student_id) DO NOTHING", (session_to_use, student_id))
-            else:
-                if session_ids:
-                    cur.execute("DELETE FROM attendance_records WHERE student_id = %s AND session_id = ANY(%s)", (student_id, session_ids))
-            conn.commit()
-            return jsonify({"success": True})
-    except (Exception, psycopg2.Error) as e:
-        if conn: conn.rollback(); print(f"Error: {e}")
-        return jsonify({"success": False, "message": "Server error."}), 500
-    finally:
-        if conn: conn.close()
+        with db_conn() as conn:
+            try:
+                with conn.cursor() as cur:
+                    class_id = get_class_id_by_name(conn)
+                    day_start, day_end = utc_day_bounds(datetime.strptime(date_str, '%Y-%m-%d').date())
+                    cur.execute("SELECT id FROM attendance_sessions WHERE class_id = %s AND start_time >= %s AND start_time < %s ORDER BY start_time", (class_id, day_start, day_end))
+                    session_ids = [row[0] for row in cur.fetchall()]
+                    if is_present:
+                        session_to_use = session_ids[0] if session_ids else None
+                        if not session_to_use:
+                            cur.execute("INSERT INTO attendance_sessions (class_id, controller_id, session_token, start_time, end_time, is_active) VALUES (%s, %s, %s, %s, %s, FALSE) RETURNING id", (class_id, session['user_id'], f"manual-{secrets.token_hex(8)}", day_start, day_start))
+                            session_to_use = cur.fetchone()[0]
+                        cur.execute("INSERT INTO attendance_records (session_id, student_id, timestamp, ip_address) VALUES (%s, %s, NOW() AT TIME ZONE 'UTC', 'Manual Edit') ON CONFLICT (session_id, student_id) DO NOTHING", (session_to_use, student_id))
+                    else:
+                        if session_ids:
+                            cur.execute("DELETE FROM attendance_records WHERE student_id = %s AND session_id = ANY(%s)", (student_id, session_ids))
+                    conn.commit()
+                    return jsonify({"success": True})
+            except (Exception, psycopg.Error) as e:
+                conn.rollback(); print(f"Error: {e}")
+                return jsonify({"success": False, "message": "Server error."}), 500
+    except psycopg.OperationalError:
+        return jsonify({"success": False, "message": "Database error."}), 500
+
+@app.route('/api/bulk_toggle_attendance_for_day', methods=['POST'])
+@controller_required
+def api_bulk_toggle_attendance_for_day():
+    # Applies a whole class worth of edits in one transaction instead of one
+    # HTTP call per student: body is {date, present: [ids], absent: [ids]}.
+    data = request.get_json()
+    date_str = data.get('date')
+    present_ids = data.get('present') or []
+    absent_ids = data.get('absent') or []
+    try:
+        with db_conn() as conn:
+            try:
+                with conn.cursor() as cur:
+                    class_id = get_class_id_by_name(conn)
+                    day_start, day_end = utc_day_bounds(datetime.strptime(date_str, '%Y-%m-%d').date())
+                    cur.execute("SELECT id FROM attendance_sessions WHERE class_id = %s AND start_time >= %s AND start_time < %s ORDER BY start_time", (class_id, day_start, day_end))
+                    session_ids = [row[0] for row in cur.fetchall()]
+                    if present_ids:
+                        session_to_use = session_ids[0] if session_ids else None
+                        if not session_to_use:
+                            cur.execute("INSERT INTO attendance_sessions (class_id, controller_id, session_token, start_time, end_time, is_active) VALUES (%s, %s, %s, %s, %s, FALSE) RETURNING id", (class_id, session['user_id'], f"manual-{secrets.token_hex(8)}", day_start, day_start))
+                            session_to_use = cur.fetchone()[0]
+                        cur.execute("INSERT INTO attendance_records (session_id, student_id, timestamp, ip_address) SELECT %s, sid, NOW() AT TIME ZONE 'UTC', 'Manual Edit' FROM unnest(%s::int[]) AS sid ON CONFLICT (session_id, student_id) DO NOTHING", (session_to_use, present_ids))
+                    if absent_ids and session_ids:
+                        cur.execute("DELETE FROM attendance_records WHERE session_id = ANY(%s) AND student_id = ANY(%s::int[])", (session_ids, absent_ids))
+                    conn.commit()
+                    return jsonify({"success": True})
+            except (Exception, psycopg.Error) as e:
+                conn.rollback(); print(f"Error: {e}")
+                return jsonify({"success": False, "message": "Server error."}), 500
+    except psycopg.OperationalError:
+        return jsonify({"success": False, "message": "Database error."}), 500
 
 @app.route('/api/delete_day/<date_str>', methods=['DELETE'])
 @controller_required
 def api_delete_day(date_str):
-    conn = get_db_connection()
-    if not conn: return jsonify({"success": False, "message": "Database error."}), 503
     try:
-        with conn.cursor() as cur:
-            class_id = get_class_id_by_name(cur)
-            target_date = datetime.strptime(date_str, '%Y-%m-%d').date()
-            cur.execute("SELECT id FROM attendance_sessions WHERE class_id = %s AND DATE(start_time AT TIME ZONE 'UTC') = %s", (class_id, target_date))
-            session_ids = [row[0] for row in cur.fetchall()]
-            if session_ids:
-                cur.execute("DELETE FROM session_device_fingerprints WHERE session_id = ANY(%s)", (session_ids,))
-                cur.execute("DELETE FROM attendance_records WHERE session_id = ANY(%s)", (session_ids,))
-                cur.execute("DELETE FROM attendance_sessions WHERE id = ANY(%s)", (session_ids,))
-            conn.commit()
-            return jsonify({"success": True, "message": f"All records for {date_str} deleted."})
-    except (Exception, psycopg2.Error) as e:
-        if conn: conn.rollback()
-        return jsonify({"success": False, "message": "Server error during deletion."}), 500
-    finally:
-        if conn: conn.close()
+        with db_conn() as conn:
+            try:
+                with conn.cursor() as cur:
+                    class_id = get_class_id_by_name(conn)
+                    day_start, day_end = utc_day_bounds(datetime.strptime(date_str, '%Y-%m-%d').date())
+                    cur.execute("SELECT id FROM attendance_sessions WHERE class_id = %s AND start_time >= %s AND start_time < %s", (class_id, day_start, day_end))
+                    session_ids = [row[0] for row in cur.fetchall()]
+                    if session_ids:
+                        cur.execute("DELETE FROM session_device_fingerprints WHERE session_id = ANY(%s)", (session_ids,))
+                        cur.execute("DELETE FROM attendance_records WHERE session_id = ANY(%s)", (session_ids,))
+                        cur.execute("DELETE FROM attendance_sessions WHERE id = ANY(%s)", (session_ids,))
+                    conn.commit()
+                    return jsonify({"success": True, "message": f"All records for {date_str} deleted."})
+            except (Exception, psycopg.Error) as e:
+                conn.rollback()
+                return jsonify({"success": False, "message": "Server error during deletion."}), 500
+    except psycopg.OperationalError:
+        return jsonify({"success": False, "message": "Database error."}), 503
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 10000))
     debug = os.environ.get('FLASK_DEBUG', 'False').lower() in ['true', '1', 't']
     app.run(host='0.0.0.0', port=port, debug=debug)
-
@@ -234,3 +234,29 @@ INSERT INTO students (enrollment_no, name, batch) VALUES
 ('Y24130009', 'SHOBHNA YADAV', 'BA'),
 ('Y24130058', 'MUSKAN BANO', 'BA')
 ON CONFLICT (enrollment_no) DO NOTHING;
+
+-- === INDEXES FOR HOT QUERY PREDICATES ===
+
+-- Active-session lookups (student page, dashboard, start_session) filter on
+-- class, activity flag and expiry.
+CREATE INDEX IF NOT EXISTS idx_sessions_class_active_end
+    ON attendance_sessions (class_id, is_active, end_time);
+
+-- Per-day queries filter sessions with half-open start_time ranges, so a
+-- plain btree on (class_id, start_time) serves them without a functional index.
+CREATE INDEX IF NOT EXISTS idx_sessions_class_start_time
+    ON attendance_sessions (class_id, start_time);
+
+-- Student lookups always filter on batch + enrollment number.
+CREATE INDEX IF NOT EXISTS idx_students_batch_enrollment
+    ON students (batch, enrollment_no);
+
+-- Duplicate-IP check in mark_attendance probes records by session and IP.
+-- (Lookups on session_id alone are covered by the UNIQUE (session_id,
+-- student_id) constraint on attendance_records.)
+CREATE INDEX IF NOT EXISTS idx_records_session_ip
+    ON attendance_records (session_id, ip_address);
+
+-- Duplicate-today check joins records back to sessions via student_id.
+CREATE INDEX IF NOT EXISTS idx_records_student
+    ON attendance_records (student_id);